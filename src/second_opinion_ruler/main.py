@@ -1,5 +1,8 @@
+import re
 import typing as t
 import warnings
+from collections import defaultdict
+from itertools import chain
 
 from spacy.errors import Errors
 from spacy.language import Language
@@ -10,6 +13,11 @@ from spacy.util import registry
 DateFormat = str
 SinglePattern = str | list[dict[str, t.Any]]
 
+# token patterns with long runs of optional tokens make the Matcher enumerate a
+# combinatorial number of candidate spans per doc
+MAX_CONSECUTIVE_OPTIONAL_TOKENS = 4
+OPTIONAL_OPS = ("?", "*")
+
 
 class _OnMatchArgs(t.TypedDict):
     id: str
@@ -30,12 +38,37 @@ class Pattern(_Pattern, total=False):
     on_match: OnMatchArgs
 
 
-class MatchLabelById(t.TypedDict):
-    id: str
+class MatchLabelById(t.NamedTuple):
     label: str
+    id: str
     on_match: OnMatchArgs | None
 
 
+def _is_optional_op(op: t.Any) -> bool:
+    if op in OPTIONAL_OPS:
+        return True
+    # range quantifiers such as {,m} or {0,m} may match zero tokens as well
+    quantifier = re.fullmatch(r"\{(\d*),(\d*)\}", op) if isinstance(op, str) else None
+    return quantifier is not None and int(quantifier.group(1) or 0) == 0
+
+
+def _max_consecutive_optional_tokens(pattern: list[dict[str, t.Any]]) -> int:
+    longest = current = 0
+    for token in pattern:
+        # malformed tokens are left for the Matcher to report
+        if not isinstance(token, dict):
+            current = 0
+            continue
+        # the Matcher accepts pattern keys in any case
+        token = {k.upper(): v for k, v in token.items() if isinstance(k, str)}
+        if _is_optional_op(token.get("OP")):
+            current += 1
+            longest = max(longest, current)
+        else:
+            current = 0
+    return longest
+
+
 @Language.factory(
     "second_opinion_ruler",
     assigns=["doc.spans"],
@@ -47,6 +80,8 @@ class MatchLabelById(t.TypedDict):
         "phrase_matcher_attr": None,
         "validate": False,
         "overwrite": True,
+        "batch_size": 1000,
+        "n_process": 1,
         "scorer": {
             "@scorers": "spacy.overlapping_labeled_spans_scorer.v1",
             "spans_key": DEFAULT_SPANS_KEY,
@@ -72,6 +107,8 @@ def make_second_opinion_ruler(
     phrase_matcher_attr: t.Optional[int | str],
     validate: bool,
     overwrite: bool,
+    batch_size: int,
+    n_process: int,
     scorer: t.Optional[t.Callable],
 ):
     return SecondOpinionRuler(
@@ -84,102 +121,265 @@ def make_second_opinion_ruler(
         phrase_matcher_attr=phrase_matcher_attr,
         validate=validate,
         overwrite=overwrite,
+        batch_size=batch_size,
+        n_process=n_process,
         scorer=scorer,
     )
 
 
 class SecondOpinionRuler(SpanRuler):
-    def __init__(self, nlp: Language, name: str = "second_opinion_ruler", **kwargs):
+    _match_label_id_map: dict[int, MatchLabelById]
+    _patterns: list[Pattern]
+    _on_match_cache: dict[str, t.Callable[..., list[Span]]]
+    _has_on_match: bool
+
+    def __init__(
+        self,
+        nlp: Language,
+        name: str = "second_opinion_ruler",
+        *,
+        batch_size: int = 1000,
+        n_process: int = 1,
+        **kwargs,
+    ):
         super().__init__(nlp, name, **kwargs)
-        self._match_label_id_map: dict[int, MatchLabelById] = {}
-        self._patterns: list[Pattern] = []
+        self._batch_size = batch_size
+        self._n_process = n_process
 
-    def add_patterns(self, patterns: list[Pattern]) -> None:
+    def clear(self) -> None:
+        """Reset all patterns, their match labels and cached on_match callbacks."""
+        super().clear()
+        self._match_label_id_map = {}
+        self._has_on_match = False
+        self._on_match_cache = {}
+
+    def __contains__(self, label: str) -> bool:
+        """Whether a label is present in the patterns."""
+        return any(entry.label == label for entry in self._match_label_id_map.values())
+
+    def add_patterns(self, patterns: t.Iterable[Pattern]) -> None:
         """Add patterns to the span ruler. A pattern can either be a token
         pattern (list of dicts) or a phrase pattern (string). For example:
         {'label': 'ORG', 'pattern': 'Apple'}
         {'label': 'ORG', 'pattern': 'Apple', 'id': 'apple'}
         {'label': 'GPE', 'pattern': [{'lower': 'san'}, {'lower': 'francisco'}]}
 
-        patterns (list): The patterns to add.
+        patterns (iterable): The patterns to add.
 
         DOCS: https://spacy.io/api/spanruler#add_patterns
         """
 
-        # disable the nlp components after this one in case they haven't been
+        # disable this component and the ones after it in case they haven't been
         # initialized / deserialized yet
+        subsequent_pipes: list[str] = []
+        for i, (_, pipe) in enumerate(self.nlp.pipeline):
+            if pipe is self:
+                subsequent_pipes = self.nlp.pipe_names[i:]
+                break
+        patterns = list(patterns)
+        for entry in patterns:
+            if not isinstance(entry["pattern"], (str, list)):
+                raise ValueError(Errors.E097.format(pattern=entry["pattern"]))
+
+        strings = self.nlp.vocab.strings
+        labels: list[str] = []
+        phrase_patterns: list[tuple[str, str]] = []
+        token_patterns: dict[str, list[list[dict[str, t.Any]]]] = defaultdict(list)
+        for entry in patterns:
+            p_on_match = entry.get("on_match")
+            p_on_match_id = "" if p_on_match is None else p_on_match["id"]
+            # the unit separator can't clash with label / id characters and
+            # is much cheaper to build than the repr of a tuple
+            label = f"{entry['label']}\x1f{entry.get('id', '')}\x1f{p_on_match_id}"
+            labels.append(label)
+            if isinstance(entry["pattern"], str):
+                phrase_patterns.append((label, entry["pattern"]))
+            else:
+                n_optional = _max_consecutive_optional_tokens(entry["pattern"])
+                if n_optional > MAX_CONSECUTIVE_OPTIONAL_TOKENS:
+                    warnings.warn(
+                        f"Token pattern for label '{entry['label']}' has {n_optional} "
+                        "consecutive optional tokens which can make matching "
+                        "very slow. Consider splitting it into several patterns "
+                        "of fixed length."
+                    )
+                token_patterns[label].append(entry["pattern"])
+
+        # only record the patterns that made it into a matcher so the ruler stays
+        # consistent with its matchers if one of them rejects a pattern
+        added_token_labels: set[str] = set()
+        added_phrase_labels: set[str] = set()
         try:
-            current_index = -1
-            for i, (name, pipe) in enumerate(self.nlp.pipeline):
-                if self == pipe:
-                    current_index = i
-                    break
-            subsequent_pipes = [pipe for pipe in self.nlp.pipe_names[current_index:]]
-        except ValueError:
-            subsequent_pipes = []
-        with self.nlp.select_pipes(disable=subsequent_pipes):
-            phrase_pattern_labels = []
-            phrase_pattern_texts = []
-            for entry in patterns:
-                p_label = entry["label"]
-                p_id = entry.get("id", "")
-                p_on_match = entry.get("on_match")
-                p_on_match_id = "" if p_on_match is None else p_on_match["id"]
-                label = repr((p_label, p_id, p_on_match_id))
-                self._match_label_id_map[self.nlp.vocab.strings.as_int(label)] = {
-                    "label": p_label,
-                    "id": p_id,
-                    "on_match": p_on_match,
-                }
+            with self.nlp.select_pipes(disable=subsequent_pipes):
+                # add all patterns of a label in one go to the matchers
+                for label, token_pattern_list in token_patterns.items():
+                    self.matcher.add(label, token_pattern_list)
+                    added_token_labels.add(label)
+                if phrase_patterns:
+                    phrase_docs: dict[str, list[Doc]] = defaultdict(list)
+                    # gazetteers often repeat surface forms across labels so
+                    # only tokenize each distinct text once
+                    texts = list(dict.fromkeys(text for _, text in phrase_patterns))
+                    docs_by_text = dict(zip(texts, self._make_phrase_docs(texts)))
+                    for label, text in phrase_patterns:
+                        phrase_docs[label].append(docs_by_text[text])
+                    for label, docs in phrase_docs.items():
+                        self.phrase_matcher.add(label, docs)
+                        added_phrase_labels.add(label)
+        finally:
+            for label, entry in zip(labels, patterns):
                 if isinstance(entry["pattern"], str):
-                    phrase_pattern_labels.append(label)
-                    phrase_pattern_texts.append(entry["pattern"])
-                elif isinstance(entry["pattern"], list):
-                    self.matcher.add(label, [entry["pattern"]])
+                    added = label in added_phrase_labels
                 else:
-                    raise ValueError(Errors.E097.format(pattern=entry["pattern"]))
+                    added = label in added_token_labels
+                if not added:
+                    continue
+                p_on_match = entry.get("on_match")
+                self._has_on_match |= p_on_match is not None
+                self._match_label_id_map[strings.add(label)] = MatchLabelById(
+                    entry["label"], entry.get("id", ""), p_on_match
+                )
                 self._patterns.append(entry)
-            for label, pattern in zip(
-                phrase_pattern_labels,
-                self.nlp.pipe(phrase_pattern_texts),
-            ):
-                self.phrase_matcher.add(label, [pattern])
-
-    def _get_spans(self, span: Span, on_match: OnMatchArgs | None) -> list[Span]:
-        if on_match is None:
-            return [span]
-        else:
-            fn: None | t.Callable[[t.Any], list[Span]] = registry.misc.get(
-                on_match["id"]
+
+    def remove(self, label: str) -> None:
+        """Remove a pattern by its label.
+
+        label (str): Label of the pattern to be removed.
+        RETURNS: None
+        DOCS: https://spacy.io/api/spanruler#remove
+        """
+        if label not in self:
+            raise ValueError(
+                Errors.E1024.format(attr_type="label", label=label, component=self.name)
             )
-            if fn is None:
-                warnings.warn(Errors.W001.format(on_match["id"]))
+        self._patterns = [p for p in self._patterns if p["label"] != label]
+        self._remove_matches(
+            m_id
+            for m_id, entry in self._match_label_id_map.items()
+            if entry.label == label
+        )
+
+    def remove_by_id(self, pattern_id: str) -> None:
+        """Remove a pattern by its pattern ID.
+
+        pattern_id (str): ID of the pattern to be removed.
+        RETURNS: None
+        DOCS: https://spacy.io/api/spanruler#remove_by_id
+        """
+        orig_len = len(self)
+        self._patterns = [p for p in self._patterns if p.get("id") != pattern_id]
+        if orig_len == len(self):
+            raise ValueError(
+                Errors.E1024.format(
+                    attr_type="ID", label=pattern_id, component=self.name
+                )
+            )
+        self._remove_matches(
+            m_id
+            for m_id, entry in self._match_label_id_map.items()
+            if entry.id == pattern_id
+        )
+
+    def _remove_matches(self, m_ids: t.Iterable[int]) -> None:
+        for m_id in list(m_ids):
+            del self._match_label_id_map[m_id]
+            m_label = self.nlp.vocab.strings.as_string(m_id)
+            if m_label in self.phrase_matcher:
+                self.phrase_matcher.remove(m_label)
+            if m_label in self.matcher:
+                self.matcher.remove(m_label)
+
+    def _make_phrase_docs(self, texts: t.Iterable[str]) -> t.Iterator[Doc]:
+        # the tokenizer is all that is needed unless the phrase matcher matches
+        # on an attribute that is set by one of the preceding components. The
+        # tokenizer runs in this process so n_process only applies to nlp.pipe
+        if self.phrase_matcher_attr is None:
+            tokenizer_pipe = getattr(self.nlp.tokenizer, "pipe", None)
+            if tokenizer_pipe is None:
+                # custom tokenizers are only required to be callable
+                return (self.nlp.make_doc(text) for text in texts)
+            return tokenizer_pipe(texts, batch_size=self._batch_size)
+        return self.nlp.pipe(
+            texts, batch_size=self._batch_size, n_process=self._n_process
+        )
+
+    def _get_spans(self, span: Span, on_match: OnMatchArgs) -> list[Span]:
+        fn = self._on_match_cache.get(on_match["id"])
+        if fn is None:
+            if on_match["id"] not in registry.misc:
+                warnings.warn(
+                    f"No function '{on_match['id']}' found in registry.misc, "
+                    "keeping the matched span as is."
+                )
                 return [span]
+            fn = registry.misc.get(on_match["id"])
+            self._on_match_cache[on_match["id"]] = fn
 
-            return fn(span, *on_match.get("args", []), **on_match.get("kwargs", {}))
+        return fn(span, *on_match.get("args", []), **on_match.get("kwargs", {}))
 
     def match(self, doc: Doc) -> list[Span]:
         self._require_patterns()
-        with warnings.catch_warnings():
-            warnings.filterwarnings("ignore", message="\\[W036")
-            matches = t.cast(
-                list[t.Tuple[int, int, int]],
-                list(self.matcher(doc)) + list(self.phrase_matcher(doc)),
-            )
+        # only call matchers that have patterns; an empty Matcher warns with W036
+        # on every call which would otherwise have to be filtered per doc
+        matches = t.cast(
+            t.Iterable[t.Tuple[int, int, int]],
+            chain(
+                self.matcher(doc) if len(self.matcher) > 0 else (),
+                self.phrase_matcher(doc) if len(self.phrase_matcher) > 0 else (),
+            ),
+        )
 
-        deduplicated_matches = set(
-            span
-            for m_id, start, end in matches
-            for span in self._get_spans(
-                Span(
-                    doc,
-                    start,
-                    end,
-                    label=self._match_label_id_map[m_id]["label"],
-                    span_id=self._match_label_id_map[m_id]["id"],
-                ),
-                self._match_label_id_map[m_id]["on_match"],
-            )
-            if start != end
+        if self._has_on_match:
+            spans = self._match_with_handlers(doc, matches)
+        else:
+            spans = self._match_without_handlers(doc, matches)
+        spans.sort(
+            key=lambda span: (span.start, span.end, span.label, span.kb_id, span.id)
         )
-        return sorted(list(deduplicated_matches))  # type: ignore
+        return spans
+
+    def _match_without_handlers(
+        self, doc: Doc, matches: t.Iterable[t.Tuple[int, int, int]]
+    ) -> list[Span]:
+        # without handlers a match id maps to exactly one label and id, so the
+        # match itself is the deduplication key
+        label_map = self._match_label_id_map
+        deduplicated: dict[t.Tuple[int, int, int], Span] = {}
+        for match in matches:
+            m_id, start, end = match
+            if start != end and match not in deduplicated:
+                entry = label_map[m_id]
+                deduplicated[match] = Span(
+                    doc, start, end, label=entry.label, span_id=entry.id
+                )
+        return list(deduplicated.values())
+
+    def _match_with_handlers(
+        self, doc: Doc, matches: t.Iterable[t.Tuple[int, int, int]]
+    ) -> list[Span]:
+        # deduplicate on lightweight tuple keys rather than hashing and
+        # comparing Span objects
+        label_map = self._match_label_id_map
+        deduplicated: dict[tuple[int, int, str, str, str], Span] = {}
+        handled: set[tuple[int, int, int]] = set()
+        for m_id, start, end in matches:
+            if start == end:
+                continue
+            entry = label_map[m_id]
+            on_match = entry.on_match
+            if on_match is None:
+                key = (start, end, entry.label, "", entry.id)
+                if key not in deduplicated:
+                    deduplicated[key] = Span(
+                        doc, start, end, label=entry.label, span_id=entry.id
+                    )
+            elif (m_id, start, end) not in handled:
+                # the same match can be found by both matchers, but the handler
+                # only needs to give its second opinion once
+                handled.add((m_id, start, end))
+                matched = Span(doc, start, end, label=entry.label, span_id=entry.id)
+                for span in self._get_spans(matched, on_match):
+                    deduplicated.setdefault(
+                        (span.start, span.end, span.label_, span.kb_id_, span.id_), span
+                    )
+        return list(deduplicated.values())
@@ -1,9 +1,11 @@
 import datetime
+import warnings
 
 import pytest
 import spacy
+from spacy.errors import MatchPatternError
 from spacy.language import Language
-from spacy.tokens import Span
+from spacy.tokens import Doc, Span
 from spacy.util import registry
 
 from second_opinion_ruler import SecondOpinionRuler
@@ -130,6 +132,24 @@ def test_ignore_match_on_large_doc(nlp: Language, ruler: SecondOpinionRuler):
     assert len(doc.ents) == 0
 
 
+def test_unknown_on_match(nlp: Language, ruler: SecondOpinionRuler):
+    ruler.clear()
+    ruler.add_patterns(
+        [{"label": "LOREM", "pattern": "lorem", "on_match": {"id": "unknown.v1"}}]
+    )
+
+    with pytest.warns(UserWarning, match="unknown.v1"):
+        doc = nlp("lorem ipsum")
+    assert len(doc.ents) == 1
+
+    @registry.misc("unknown.v1")
+    def no_match(span: Span) -> list[Span]:
+        return []
+
+    doc = nlp("lorem ipsum")
+    assert len(doc.ents) == 0
+
+
 def test_example():
     import spacy
     from spacy.tokens import Span
@@ -184,3 +204,242 @@ def test_example():
 
     # verify
     assert doc.ents[0]._.date == datetime.datetime(1986, 4, 21)
+
+
+def test_phrase_matcher_attr():
+    nlp = spacy.blank("en")
+    ruler = nlp.add_pipe(
+        "second_opinion_ruler",
+        config={
+            "annotate_ents": True,
+            "phrase_matcher_attr": "LOWER",
+            "batch_size": 2,
+        },
+    )
+    ruler.add_patterns(  # type: ignore
+        [
+            {"label": "ORG", "pattern": "Apple"},
+            {"label": "GPE", "pattern": "San Francisco"},
+            {"label": "GPE", "pattern": "Copenhagen"},
+        ]
+    )
+
+    doc = nlp("apple opened an office in san francisco")
+    assert [(ent.label_, ent.text) for ent in doc.ents] == [
+        ("ORG", "apple"),
+        ("GPE", "san francisco"),
+    ]
+
+
+def test_custom_tokenizer():
+    class WhitespaceTokenizer:
+        def __init__(self, vocab):
+            self.vocab = vocab
+
+        def __call__(self, text):
+            return Doc(self.vocab, words=text.split(" "))
+
+    nlp = spacy.blank("en")
+    nlp.tokenizer = WhitespaceTokenizer(nlp.vocab)
+    ruler = nlp.add_pipe("second_opinion_ruler", config={"annotate_ents": True})
+    ruler.add_patterns([{"label": "X", "pattern": "foo bar"}])  # type: ignore
+
+    doc = nlp("foo bar baz")
+    assert [(ent.label_, ent.text) for ent in doc.ents] == [("X", "foo bar")]
+
+
+def test_no_matcher_warnings(nlp: Language, ruler: SecondOpinionRuler):
+    ruler.clear()
+    ruler.add_patterns([{"label": "DATE", "pattern": "21.04.1986"}])
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        doc = nlp("My birthday is 21.04.1986")
+    assert len(doc.ents) == 1
+
+
+def test_deduplicate_matches(nlp: Language, ruler: SecondOpinionRuler):
+    ruler.clear()
+    ruler.add_patterns(
+        [
+            {"label": "GPE", "pattern": "Copenhagen"},
+            {"label": "GPE", "pattern": [{"ORTH": "Copenhagen"}]},
+            {"label": "CITY", "pattern": "Copenhagen"},
+            {"label": "GPE", "pattern": "Denmark"},
+        ]
+    )
+
+    doc = nlp("Copenhagen is the capital of Denmark")
+    spans = ruler.match(doc)
+    assert len(spans) == 3
+    assert {(span.label_, span.text) for span in spans} == {
+        ("CITY", "Copenhagen"),
+        ("GPE", "Copenhagen"),
+        ("GPE", "Denmark"),
+    }
+    assert spans[-1].text == "Denmark"
+
+
+def test_on_match_called_once_per_match(nlp: Language, ruler: SecondOpinionRuler):
+    calls: list[str] = []
+
+    @registry.misc("count_calls.v1")
+    def count_calls(span: Span) -> list[Span]:
+        calls.append(span.text)
+        return [span]
+
+    ruler.clear()
+    ruler.add_patterns(
+        [
+            {
+                "label": "GPE",
+                "pattern": "Copenhagen",
+                "on_match": {"id": "count_calls.v1"},
+            },
+            {
+                "label": "GPE",
+                "pattern": [{"ORTH": "Copenhagen"}],
+                "on_match": {"id": "count_calls.v1"},
+            },
+        ]
+    )
+
+    doc = nlp("Copenhagen")
+    assert len(doc.ents) == 1
+    assert calls == ["Copenhagen"]
+
+
+def test_serialization(tmp_path):
+    nlp = spacy.blank("en")
+    ruler = nlp.add_pipe("second_opinion_ruler", config={"annotate_ents": True})
+    ruler.add_patterns(  # type: ignore
+        [
+            {
+                "label": "DATE",
+                "pattern": "21.04.1986",
+                "on_match": {
+                    "id": "to_datetime.v1",
+                    "kwargs": {"format": "%d.%m.%Y", "attr": "my_date"},
+                },
+            },
+            {"label": "GPE", "pattern": [{"LOWER": "copenhagen"}]},
+        ]
+    )
+    nlp.to_disk(tmp_path)
+
+    for loaded in (
+        spacy.load(tmp_path),
+        spacy.blank("en", config=nlp.config).from_bytes(nlp.to_bytes()),
+    ):
+        doc = loaded("Copenhagen on 21.04.1986")
+        assert [(ent.label_, ent.text) for ent in doc.ents] == [
+            ("GPE", "Copenhagen"),
+            ("DATE", "21.04.1986"),
+        ]
+        assert doc.ents[1]._.my_date == datetime.datetime(1986, 4, 21)
+
+
+def test_warn_on_many_optional_tokens(ruler: SecondOpinionRuler):
+    ruler.clear()
+    with pytest.warns(UserWarning, match="5 consecutive optional tokens"):
+        ruler.add_patterns(
+            [
+                {
+                    "label": "ADDRESS",
+                    "pattern": [{"IS_DIGIT": True}]
+                    + [{"IS_ALPHA": True, "OP": "?"}] * 5
+                    + [{"LOWER": "street"}],
+                }
+            ]
+        )
+
+    with pytest.warns(UserWarning, match="6 consecutive optional tokens"):
+        ruler.add_patterns(
+            [
+                {
+                    "label": "ADDRESS",
+                    "pattern": [{"is_digit": True}]
+                    + [{"is_alpha": True, "op": "?"}] * 3
+                    + [{"is_alpha": True, "op": "{,2}"}] * 2
+                    + [{"is_alpha": True, "op": "{0,2}"}]
+                    + [{"lower": "street"}],
+                }
+            ]
+        )
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        ruler.add_patterns(
+            [
+                {
+                    "label": "ADDRESS",
+                    "pattern": [{"IS_DIGIT": True}]
+                    + [{"IS_ALPHA": True, "OP": "?"}] * 4
+                    + [{"LOWER": "street"}],
+                }
+            ]
+        )
+
+
+def test_malformed_token_pattern(ruler: SecondOpinionRuler):
+    ruler.clear()
+    with pytest.raises(MatchPatternError):
+        ruler.add_patterns([{"label": "A", "pattern": ["foo"]}])  # type: ignore
+
+    nlp = spacy.blank("en")
+    ruler = nlp.add_pipe("second_opinion_ruler")  # type: ignore
+    with pytest.raises(ValueError, match="E154"):
+        ruler.add_patterns([{"label": "A", "pattern": ["foo"]}])  # type: ignore
+
+
+def test_failing_add_patterns_is_consistent(nlp: Language, ruler: SecondOpinionRuler):
+    ruler.clear()
+    with pytest.raises(ValueError, match="E097"):
+        ruler.add_patterns(
+            [
+                {"label": "A", "pattern": [{"LOWER": "foo"}]},
+                {"label": "BAD", "pattern": 42},  # type: ignore
+            ]
+        )
+    assert len(ruler) == 0
+    assert "A" not in ruler
+    assert len(ruler.matcher) == 0
+
+    with pytest.raises(MatchPatternError):
+        ruler.add_patterns(
+            [
+                {"label": "A", "pattern": [{"LOWER": "foo"}]},
+                {"label": "B", "pattern": "bar"},
+                {"label": "BAD", "pattern": ["foo"]},  # type: ignore
+            ]
+        )
+    # patterns are only recorded once their matcher has accepted them
+    assert ruler.labels == ("A",)
+    assert len(ruler.matcher) == 1
+    assert len(ruler.phrase_matcher) == 0
+    doc = nlp("foo bar")
+    assert [(ent.label_, ent.text) for ent in doc.ents] == [("A", "foo")]
+
+
+def test_remove(nlp: Language, ruler: SecondOpinionRuler):
+    ruler.clear()
+    ruler.add_patterns(
+        [
+            {"label": "GPE", "pattern": "Copenhagen", "id": "cph"},
+            {"label": "GPE", "pattern": [{"LOWER": "denmark"}], "id": "dk"},
+            {"label": "ORG", "pattern": "Apple"},
+        ]
+    )
+    assert "GPE" in ruler
+
+    ruler.remove_by_id("dk")
+    doc = nlp("Apple in Copenhagen, Denmark")
+    assert [ent.text for ent in doc.ents] == ["Apple", "Copenhagen"]
+
+    ruler.remove("GPE")
+    assert "GPE" not in ruler
+    doc = nlp("Apple in Copenhagen, Denmark")
+    assert [ent.text for ent in doc.ents] == ["Apple"]
+
+    with pytest.raises(ValueError):
+        ruler.remove("GPE")